@@ -1,8 +1,17 @@
 import datetime
+import hashlib
+import io
+import threading
+import time
+import backoff
+import diskcache
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import streamlit as st
 import openai
-from typing import Tuple
+from PIL import Image, ImageOps
+from typing import Any, Dict, Iterator, List, Tuple
 
 st.set_page_config(page_title="宇宙とあなたの運命", page_icon="✨", layout="centered")
 
@@ -12,68 +21,267 @@ if "OPENAI_API_KEY" not in st.secrets or "NASA_API_KEY" not in st.secrets:
     st.stop()
 
 openai.api_key = st.secrets["OPENAI_API_KEY"]
+# 再試行は create_chat_stream の backoff だけに任せる（SDK 内部のリトライと重ねない）
+openai.max_retries = 0
+openai.timeout = 30
 NASA_API_KEY = st.secrets["NASA_API_KEY"]
 
-# 🛰️ NASAの宇宙画像を取得
-def get_apod(today: datetime.date) -> Tuple[str, str, str]:
+APOD_FIRST_DATE = datetime.date(1995, 6, 16)
+APOD_MAX_FALLBACK_DAYS = 7
+
+OPENAI_MODEL = "gpt-4o-mini"
+FORTUNE_CACHE_TTL = 60 * 60 * 24
+
+# アカウントの上限に合わせて調整する（1分あたりのリクエスト数）
+OPENAI_MAX_REQUESTS_PER_MINUTE = 60
+NASA_MAX_REQUESTS_PER_MINUTE = 30
+# NASA API の X-RateLimit-Remaining は1時間あたりの残り回数
+NASA_RATE_LIMIT_WINDOW = 60 * 60
+
+class RateLimitExceededError(RuntimeError):
+    pass
+
+# 🚦 リーキーバケット方式のレート制限（全セッションのスレッドで共有）
+class RateLimiter:
+    def __init__(self, max_rate: float, time_period: float = 60, max_wait: float = 10):
+        self.time_period = time_period
+        self.max_wait = max_wait
+        self.base_max_rate = max_rate
+        self.base_leak_rate = max_rate / time_period
+        self.max_rate = max_rate
+        self.leak_rate = self.base_leak_rate
+        self._adapted_until = 0.0
+        self._level = 0.0
+        self._last_leak = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "RateLimiter":
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                # adapt で絞った速さは time_period だけ有効。過ぎたら元に戻し、次のリクエストで残り回数を確かめ直す
+                if self._adapted_until and now >= self._adapted_until:
+                    self.max_rate = self.base_max_rate
+                    self.leak_rate = self.base_leak_rate
+                    self._adapted_until = 0.0
+                self._level = max(0.0, self._level - (now - self._last_leak) * self.leak_rate)
+                self._last_leak = now
+                if self._level + 1 <= self.max_rate:
+                    self._level += 1
+                    return self
+                if self.max_rate < 1 or self.leak_rate <= 0:
+                    wait = float("inf")
+                else:
+                    wait = (self._level + 1 - self.max_rate) / self.leak_rate
+            # 長く待たせるより、すぐにエラーを表示する。待つ場合もロックの外で眠り、他のスレッドを止めない
+            if wait > self.max_wait:
+                raise RateLimitExceededError("リクエストが混み合っています。しばらくしてから再度お試しください。")
+            time.sleep(wait)
+
+    def __exit__(self, *exc_info: Any) -> None:
+        return None
+
+    def adapt(self, remaining: int, window: float) -> None:
+        # API が返す残り回数が少ないときは、残りを window 秒に均等に配分できる速さまで落とす
+        # 残りが 0 ならバースト枠も 0 になり、time_period が過ぎるまで即座にエラーとなる
+        with self._lock:
+            remaining = max(remaining, 0)
+            self.max_rate = min(self.base_max_rate, remaining)
+            self.leak_rate = min(self.base_leak_rate, remaining / window)
+            self._adapted_until = time.monotonic() + self.time_period
+
+@st.cache_resource
+def get_openai_limiter() -> RateLimiter:
+    return RateLimiter(max_rate=OPENAI_MAX_REQUESTS_PER_MINUTE)
+
+@st.cache_resource
+def get_nasa_limiter() -> RateLimiter:
+    return RateLimiter(max_rate=NASA_MAX_REQUESTS_PER_MINUTE)
+
+# 🔌 NASA API 用の HTTP セッション（接続を使い回し、一時的なエラーは自動リトライ）
+@st.cache_resource
+def get_session() -> requests.Session:
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    session.mount("https://", HTTPAdapter(max_retries=retry, pool_connections=10, pool_maxsize=10))
+    return session
+
+class ApodNotPublishedError(LookupError):
+    pass
+
+# 🛰️ 指定した日付ちょうどの APOD を取得（同じ日付の結果は全ユーザーで共有）
+# 404 は例外として扱い、キャッシュしない（公開され次第取得できるように）
+@st.cache_data(ttl=60 * 60 * 12, show_spinner=False)
+def fetch_apod(date: datetime.date) -> Tuple[str, str, str, str]:
     url = "https://api.nasa.gov/planetary/apod"
-    params = {"api_key": NASA_API_KEY, "date": today.isoformat()}
-    try:
-        res = requests.get(url, params=params, timeout=10)
-        res.raise_for_status()
-        data = res.json()
-
-        if data.get("media_type") not in {"image", "video"}:
-            raise ValueError("メディアタイプが image または video ではありません。")
-
-        media_url = data["url"]
-        title = data.get("title", "No Title")
-        explanation = data.get("explanation", "")
-
-        return media_url, title, explanation
-
-    except requests.exceptions.HTTPError as e:
-        if res.status_code == 404:
-            yesterday = today - datetime.timedelta(days=1)
-            if yesterday < datetime.date(1995, 6, 16):
-                st.error("NASA APODのデータが見つかりません。")
-                raise
-            return get_apod(yesterday)
-        else:
-            st.error(f"💥 NASA データ取得に失敗しました。\n\nError: {e}")
-            raise
-    except Exception as e:
-        st.error(f"💥 NASA データ取得に失敗しました。\n\nError: {e}")
-        raise
+    params = {"api_key": NASA_API_KEY, "date": date.isoformat()}
+    with get_nasa_limiter():
+        res = get_session().get(url, params=params, timeout=(3.05, 10))
+    remaining = res.headers.get("X-RateLimit-Remaining")
+    if remaining is not None and remaining.isdigit():
+        get_nasa_limiter().adapt(int(remaining), NASA_RATE_LIMIT_WINDOW)
+    if res.status_code == 404:
+        raise ApodNotPublishedError(date.isoformat())
+    res.raise_for_status()
+    data = res.json()
+
+    media_type = data.get("media_type")
+    if media_type not in {"image", "video"}:
+        raise ValueError("メディアタイプが image または video ではありません。")
+
+    media_url = data["url"]
+    title = data.get("title", "No Title")
+    explanation = data.get("explanation", "")
+
+    return media_url, title, explanation, media_type
 
-# 🔮 GPTによる占い生成（300文字以内・詩的）
-def generate_fortune(text: str) -> str:
+# 🛰️ NASAの宇宙画像を取得。未公開の日付は前日へさかのぼる
+# さかのぼった結果は短時間だけキャッシュし、当日分が公開されたらすぐ切り替わるようにする
+@st.cache_data(ttl=60 * 10, show_spinner=False)
+def get_apod(today: datetime.date) -> Tuple[str, str, str, str]:
+    for _ in range(APOD_MAX_FALLBACK_DAYS):
+        try:
+            return fetch_apod(today)
+        except ApodNotPublishedError:
+            if today <= APOD_FIRST_DATE:
+                break
+            today -= datetime.timedelta(days=1)
+
+    raise LookupError("NASA APODのデータが見つかりません。")
+
+# 🖼️ 表示幅に合わせて縮小した画像（フル解像度をそのままブラウザへ送らない）
+@st.cache_data(ttl=60 * 60 * 24, show_spinner=False)
+def get_thumbnail(url: str, max_width: int = 1200) -> bytes:
+    res = get_session().get(url, timeout=(3.05, 30))
+    res.raise_for_status()
+    img = Image.open(io.BytesIO(res.content))
+    # アニメーション GIF は縮小するとアニメーションが失われ、表示幅以下の画像は縮小の必要がないので元のまま返す
+    if getattr(img, "is_animated", False) or max(img.size) <= max_width:
+        return res.content
+
+    icc_profile = img.info.get("icc_profile")
+    # EXIF の回転情報は保存時に失われるので、先に画素へ反映しておく
+    img = ImageOps.exif_transpose(img)
+    has_alpha = img.mode in {"RGBA", "LA"} or "transparency" in img.info
+    if img.mode == "CMYK":
+        # CMYK 用の ICC プロファイルは RGB へ変換した画素には合わない
+        icc_profile = None
+    if img.mode not in {"RGB", "RGBA", "L", "LA"}:
+        img = img.convert("RGBA" if has_alpha else "RGB")
+    img.thumbnail((max_width, max_width))
+
+    buf = io.BytesIO()
+    if has_alpha:
+        # 透過部分が黒くならないよう、透過のある画像は PNG のまま保つ
+        img.save(buf, "PNG", optimize=True, icc_profile=icc_profile)
+    else:
+        img.save(buf, "JPEG", quality=85, optimize=True, icc_profile=icc_profile)
+    return buf.getvalue()
+
+# 💾 生成済みの占い（プロセスやセッションをまたいでディスクに保存）
+@st.cache_resource
+def get_fortune_cache() -> diskcache.Cache:
+    return diskcache.Cache(".fortune_cache")
+
+def is_quota_exhausted(e: Exception) -> bool:
+    return getattr(e, "code", None) == "insufficient_quota"
+
+# 🔁 OpenAI へのリクエスト。一時的な障害は指数バックオフで再試行し、
+# 利用上限（429）はバケットが空くまで最大30秒だけ待つ。クレジット切れ（insufficient_quota）は待っても回復しないので即座に諦める
+@backoff.on_exception(
+    backoff.expo,
+    openai.RateLimitError,
+    max_time=30,
+    jitter=backoff.full_jitter,
+    giveup=is_quota_exhausted,
+)
+@backoff.on_exception(
+    backoff.expo,
+    (openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError),
+    max_tries=4,
+    jitter=backoff.full_jitter,
+)
+def create_chat_stream(messages: List[Dict[str, str]], max_tokens: int) -> Iterator[Any]:
+    with get_openai_limiter():
+        return openai.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+
+# 🔮 GPTによる占い生成（300文字以内・詩的）。生成されたトークンから順に返す
+def generate_fortune(text: str) -> Iterator[str]:
     prompt = (
         "あなたは詩的でスピリチュアルな占い師です。"
         "以下の宇宙画像の解説をインスピレーションに、"
         "日本語で300文字以内の今日の運勢を作成してください。\n\n"
         f"【解説】\n{text}"
     )
+    system_prompt = "You are a poetic spiritual fortune teller."
+    # 同じ解説からの占いは再生成せず、保存済みのものを返す
+    cache_key = hashlib.sha1((OPENAI_MODEL + system_prompt + prompt).encode()).hexdigest()
+    # キャッシュの読み書きに失敗しても占いは表示する（読み込み失敗はキャッシュなしとして扱う）
     try:
-        completion = openai.chat.completions.create(
-            model="gpt-4o-mini",
+        cache = get_fortune_cache()
+        cached = cache.get(cache_key)
+    except Exception:
+        cache, cached = None, None
+    if cached:
+        yield cached
+        return
+
+    pieces: List[str] = []
+    try:
+        stream = create_chat_stream(
             messages=[
-                {"role": "system", "content": "You are a poetic spiritual fortune teller."},
+                {"role": "system", "content": system_prompt},
                 {"role": "user", "content": prompt},
             ],
             max_tokens=300,
         )
-        return completion.choices[0].message.content.strip()
+        for chunk in stream:
+            if chunk.choices:
+                piece = chunk.choices[0].delta.content or ""
+                pieces.append(piece)
+                yield piece
 
+    # 途中まで届いた占いに代わりのメッセージをつなげない。途切れた場合は届いた分だけを残す（キャッシュはしない）
     except openai.RateLimitError:
+        if "".join(pieces).strip():
+            st.warning("⚠️ OpenAIの利用上限に達したため、占いの受信が途中で途切れました。")
+            return
         fallback = "宇宙は静かにあなたを見守っています。今日は焦らず、自分のペースで進みましょう。"
         st.warning("⚠️ OpenAIの利用上限に達しました。代わりに星からの囁きをお届けします。")
-        return fallback
+        yield fallback
+        return
 
     except Exception as e:
+        if "".join(pieces).strip():
+            st.error(f"💥 占いの受信が途中で途切れました。\n\nError: {e}")
+            return
         fallback = "今日は心を空に向けて、穏やかな呼吸を。運命はあなたの味方です。"
         st.error(f"💥 占い生成に失敗しました。\n\nError: {e}\n代わりに自動メッセージを表示します。")
-        return fallback
+        yield fallback
+        return
+
+    fortune = "".join(pieces).strip()
+    if not fortune:
+        # 本文が空の応答（コンテンツフィルターなど）はキャッシュせず、代わりのメッセージを表示する
+        st.warning("⚠️ 星からのメッセージを受け取れませんでした。代わりに自動メッセージを表示します。")
+        yield "今日は心を空に向けて、穏やかな呼吸を。運命はあなたの味方です。"
+        return
+
+    if cache is not None:
+        try:
+            cache.set(cache_key, fortune, expire=FORTUNE_CACHE_TTL)
+        except Exception:
+            pass
 
 # 🎨 UI構築
 st.title("✨ 宇宙とあなたの運命 ✨")
@@ -85,25 +293,41 @@ if "fortune" not in st.session_state:
 if st.button("🔭 今日の宇宙画像を見る"):
     today = datetime.date.today()
     with st.spinner("宇宙からの光を受信中…"):
-        media_url, title, explanation = get_apod(today)
-        fortune = generate_fortune(explanation)
-
-        st.session_state["media_url"] = media_url
-        st.session_state["title"] = title
-        st.session_state["fortune"] = fortune
-        st.session_state["media_type"] = (
-            "video" if media_url.lower().endswith((".mp4", ".mov", ".avi")) else "image"
-        )
-        st.session_state["explanation"] = explanation
+        try:
+            media_url, title, explanation, media_type = get_apod(today)
+        except LookupError as e:
+            st.error(str(e))
+            st.stop()
+        except Exception as e:
+            st.error(f"💥 NASA データ取得に失敗しました。\n\nError: {e}")
+            st.stop()
 
-if st.session_state.get("fortune"):
-    if st.session_state["media_type"] == "image":
-        st.image(st.session_state["media_url"], use_container_width=True)
-    else:
-        st.video(st.session_state["media_url"])
+    st.session_state["media_url"] = media_url
+    st.session_state["title"] = title
+    # 占いは画像の下でストリーミング表示するため、ここでは未生成としておく
+    st.session_state["fortune"] = None
+    st.session_state["media_type"] = media_type
+    st.session_state["explanation"] = explanation
+
+if st.session_state.get("media_url"):
+    # 画像の取得と占いのストリーミングもスピナーの下で行う（最初のトークンが届くまで待機中とわかるように）
+    with st.spinner("星からのメッセージを受信中…"):
+        if st.session_state["media_type"] == "image":
+            try:
+                image = get_thumbnail(st.session_state["media_url"])
+            except Exception:
+                image = st.session_state["media_url"]
+            st.image(image, use_container_width=True)
+        elif st.session_state["media_type"] == "video":
+            st.video(st.session_state["media_url"])
 
-    st.subheader(st.session_state["title"])
-    st.markdown(f"**{st.session_state['fortune']}**")
+        st.subheader(st.session_state["title"])
+        fortune_area = st.empty()
+        if st.session_state["fortune"] is None:
+            fortune = fortune_area.write_stream(generate_fortune(st.session_state["explanation"]))
+            st.session_state["fortune"] = fortune.strip()
+        # ストリーミングが終わったら、元どおり太字で表示し直す
+        fortune_area.markdown(f"**{st.session_state['fortune']}**")
 
     with st.expander("🛰️ NASA 解説（英語原文）"):
         st.write(st.session_state["explanation"])